@@ -19,22 +19,45 @@
 #    github.com/nicolas93/escalite
 
 import argparse
+import array
 import binascii
+import collections
+import concurrent.futures
+import heapq
 import math
 import os
+import re
 import string
 import pydoc
 import struct
+import threading
 
 colorred = "\x1B[31m"
 colorgreen = "\x1B[32m"
 coloryellow = "\x1B[33m"
 colorblue = "\x1B[34m"
+colorredbg = "\x1B[41m"
 coloroff = "\x1B[0m"
 
 Digraph = None
 nohtml = None
 
+CHUNK_SIZE = 16 * 1024 * 1024
+SCAN_CHUNK_SIZE = 64 * 1024 * 1024
+SQLITE_MAGIC = b"SQLite format 3\x00"
+PAGE_SIZES = [512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+PAGE_TYPES = re.compile(b"[\x02\x05\x0a\x0d]")
+ORPHAN_GAP = 16
+ORPHAN_MAX = 4096
+READ_THREADS = 8
+READ_AHEAD = 2
+MERGE_GAP = 4
+PAGE_CACHE = 1024
+HEAT_CHARS = " .:-=+*#%@"
+HEAT_COLORS = ["#303030", "#005f87", "#0087af", "#00af87", "#5faf00", "#afaf00", "#d78700", "#d75f00", "#d70000", "#ff0000"]
+HEAT_WIDTH = 64
+TEXT_ENCODINGS = {1: "utf-8", 2: "utf-16-le", 3: "utf-16-be"}
+
 
 class Header:
     """Class containing the information about the sqlite header"""
@@ -89,6 +112,11 @@ class Header:
     def get_encoding(self):
         return self.headerbytes[56:60], self.headerbytes[56:60]
 
+    def get_text_encoding(self):
+        # 1: UTF-8, 2: UTF-16le, 3: UTF-16be. Anything else is treated as UTF-8
+        num = int.from_bytes(self.headerbytes[56:60], "big", signed=False)
+        return TEXT_ENCODINGS.get(num, "utf-8"), self.headerbytes[56:60]
+
     def get_vacuum_mode(self):
         return self.headerbytes[64:68], self.headerbytes[64:68]
 
@@ -107,6 +135,7 @@ class Header:
         s += "\tChange count: %d\n" % self.get_change_count()[0]
         s += "\tFree Pages: %d\n" % self.get_count_free_pages()[0]
         s += "\tFirst free page: %d\n" % self.get_first_free_page()[0]
+        s += "\tText encoding: %s\n" % self.get_text_encoding()[0]
         s += "\tAuto vaccuum: %s\n" % binascii.hexlify(
             self.get_auto_vacuum_mode()[1]).decode()
         s += "\tVaccuum mode: %s\n" % binascii.hexlify(
@@ -117,7 +146,7 @@ class Header:
 
 class FreeTrunkPage:
     """Class containing Information of a freelist trunk page."""
-    pagebytes = b""
+    __slots__ = ("pagebytes",)
 
     def __init__(self, pagebytes):
         self.pagebytes = pagebytes
@@ -173,7 +202,7 @@ class FreeTrunkPage:
 
 class FreeLeafPage:
     """Class containing a freelist leaf page. Should contain no information."""
-    pagebytes = b""
+    __slots__ = ("pagebytes",)
 
     def __init__(self, pagebytes):
         self.pagebytes = pagebytes
@@ -212,19 +241,36 @@ class FreeLeafPage:
         return text
 
 
+class CellValue:
+    """Class referencing a TEXT or BLOB value in the page buffer, decoded only when rendered."""
+    __slots__ = ("data", "encoding")
+
+    def __init__(self, data, encoding=None):
+        self.data = data
+        self.encoding = encoding
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bytes__(self):
+        return self.data.tobytes()
+
+    def __str__(self):
+        if(self.encoding is None):
+            return str(self.data.tobytes())
+        return str(self.data, self.encoding, "replace")
+
+
 class BTreePage:
     """Class containing a b tree page."""
+    __slots__ = ("pagebytes", "number", "negoffset", "totaloffset", "encoding")
 
-    pagebytes = b""
-    number = 0
-    negoffset = 0
-    totaloffset = 0
-
-    def __init__(self, pagebytes, number, totaloffset, negoffset=0):
+    def __init__(self, pagebytes, number, totaloffset, negoffset=0, encoding="utf-8"):
         self.pagebytes = pagebytes
         self.number = number
         self.negoffset = negoffset
         self.totaloffset = totaloffset
+        self.encoding = encoding
 
     def get_pagetype(self):
         if(self.pagebytes[0] == 0x02):
@@ -401,7 +447,7 @@ class BTreePage:
                 pointer += length
             elif(t >= 12 and t % 2 == 1):
                 length = int((t-13)/2)
-                string = self.pagebytes[pointer:pointer+length].decode()
+                string = str(CellValue(memoryview(self.pagebytes)[pointer:pointer+length], self.encoding))
                 pointer += length
             if(i == 3):
                 pagenr = value
@@ -465,6 +511,8 @@ class BTreePage:
             types.append(self.varint2int(type_bytes))
             i += 1
 
+        view = memoryview(self.pagebytes)
+        values = []
         for t in types: # See here for documentation: https://www.sqlite.org/fileformat.html
             if(t < 5):
                 print("\t" * intent + "Type: %d (int) | Value: %d" %
@@ -490,18 +538,18 @@ class BTreePage:
                 print("\t" * (2+intent) + "%sThe following offsets might be wrong and lead to wrong interpretations%s" % (colorred, coloroff))
             elif(t >= 12 and t % 2 == 0):
                 length = int((t-12)/2)
-                print("\t" * intent + "Type: BLOB    | Value: %s" %
-                      self.pagebytes[pointer:pointer+length])
+                values.append(CellValue(view[pointer:pointer+length]))
+                print("\t" * intent + "Type: BLOB    | Value: %s" % values[-1])
                 pointer += length
             elif(t >= 12 and t % 2 == 1):
                 length = int((t-13)/2)
-                print("\t" * intent + "Type: String  | Value: %s" %
-                      self.pagebytes[pointer:pointer+length].decode())
+                values.append(CellValue(view[pointer:pointer+length], self.encoding))
+                print("\t" * intent + "Type: String  | Value: %s" % values[-1])
                 pointer += length
             else:
                 print("\t" * intent + "unknown: %d | That shouldnt be possible." %t)
 
-        return 0
+        return values
 
     def read_removed_data(self):
         freeblock = self.get_first_free_cell()[0] - self.negoffset
@@ -551,6 +599,311 @@ class BTreePage:
         return s
 
 
+class PageReader:
+    """Class reading coalesced page ranges concurrently and with read-ahead."""
+
+    def __init__(self, db, pagesize, base=0, threads=READ_THREADS):
+        self.db = db
+        self.pagesize = pagesize
+        self.base = base
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        try:
+            self.fd = db.fileno() if hasattr(os, "pread") else None
+        except (AttributeError, OSError, ValueError):
+            self.fd = None
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+    def read_range(self, offset, length):
+        if(self.fd is None):
+            with self.lock:
+                self.db.seek(offset)
+                return self.db.read(length)
+        data = b""
+        while(len(data) < length):
+            part = os.pread(self.fd, length - len(data), offset + len(data))
+            if(len(part) == 0):
+                break
+            data += part
+        return data
+
+    def coalesce(self, offsets, length):
+        # Merges sorted block offsets into (offset, length) ranges, small gaps are read as well
+        ranges = []
+        for offset in sorted(set(offsets)):
+            if(len(ranges) > 0 and offset - (ranges[-1][0] + ranges[-1][1]) <= MERGE_GAP * length
+                    and offset + length - ranges[-1][0] <= CHUNK_SIZE):
+                ranges[-1][1] = offset + length - ranges[-1][0]
+            else:
+                ranges.append([offset, length])
+        return ranges
+
+    def read_blocks(self, offsets, length):
+        # Blocks past the end of the file are missing, the last block may be short
+        futures = []
+        for start, size in self.coalesce(offsets, length):
+            futures.append((start, size, self.pool.submit(self.read_range, start, size)))
+        wanted = sorted(set(offsets))
+        blocks = {}
+        i = 0
+        for start, size, future in futures:
+            data = future.result()
+            while(i < len(wanted) and wanted[i] < start + size):
+                if(wanted[i] - start < len(data)):
+                    blocks[wanted[i]] = data[wanted[i]-start:wanted[i]-start+length]
+                i += 1
+        return blocks
+
+    def read_pages(self, pagenrs):
+        offsets = {}
+        for n in pagenrs:
+            offsets[self.base + (n - 1) * self.pagesize] = n
+        blocks = self.read_blocks(offsets.keys(), self.pagesize)
+        pages = {}
+        for offset, data in blocks.items():
+            pages[offsets[offset]] = data
+        return pages
+
+    def iter_chunks(self, offset, limit, chunksize=CHUNK_SIZE):
+        pending = collections.deque()
+        try:
+            while(offset < limit or len(pending) > 0):
+                while(len(pending) < READ_AHEAD and offset < limit):
+                    length = min(chunksize, limit - offset)
+                    pending.append((offset, self.pool.submit(self.read_range, offset, length)))
+                    offset += length
+                start, future = pending.popleft()
+                data = future.result()
+                if(len(data) == 0):
+                    break
+                yield start, data
+        finally:
+            for start, future in pending:
+                future.cancel()
+
+
+class PageTable:
+    """Class containing the b tree page headers of all pages in array columns, pages are read on demand."""
+
+    def __init__(self, db, header, base=0):
+        self.header = header
+        self.base = base
+        self.pagesize = header.get_page_size()[0]
+        self.encoding = header.get_text_encoding()[0]
+        self.reader = PageReader(db, self.pagesize, base)
+        self.types = array.array("B")
+        self.freeblocks = array.array("H")
+        self.cellcounts = array.array("H")
+        self.datastarts = array.array("H")
+        self.fragments = array.array("B")
+        self.lastlength = 0
+        self.cache = collections.OrderedDict()
+
+    def close(self):
+        self.reader.close()
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, i):
+        # Indexed like the former list of pages, pages[0] is page 1
+        if(i < 0):
+            i += len(self)
+        if(i < 0 or i >= len(self)):
+            raise IndexError("page %d does not exist" % (i + 1))
+        return self.page(i + 1)
+
+    def add(self, pagebytes):
+        headerstart = 100 if(len(self) == 0) else 0
+        pageheader = pagebytes[headerstart:headerstart+8].ljust(8, b"\x00")
+        pagetype, freeblock, cellcount, datastart, fragments = struct.unpack(">BHHHB", pageheader)
+        self.types.append(pagetype)
+        self.freeblocks.append(freeblock)
+        self.cellcounts.append(cellcount)
+        self.datastarts.append(datastart)
+        self.fragments.append(fragments)
+        self.lastlength = len(pagebytes)
+
+    def get_offset(self, n):
+        return self.base + (n - 1) * self.pagesize + (100 if(n == 1) else 0)
+
+    def get_pageheader(self, n):
+        return struct.pack(">BHHHB", self.types[n-1], self.freeblocks[n-1], self.cellcounts[n-1],
+                           self.datastarts[n-1], self.fragments[n-1])
+
+    def is_interior(self, n):
+        return 0 < n <= len(self) and (self.types[n-1] == 0x02 or self.types[n-1] == 0x05)
+
+    def is_partial(self, n):
+        return n == len(self) and self.lastlength < self.pagesize
+
+    def prefetch(self, pagenrs):
+        # At most PAGE_CACHE pages, so the batch does not evict its own pages
+        missing = []
+        for n in [n for n in pagenrs if(0 < n <= len(self))][:PAGE_CACHE]:
+            if(n in self.cache):
+                self.cache.move_to_end(n)
+            else:
+                missing.append(n)
+        for n, data in self.reader.read_pages(missing).items():
+            self.store(n, data)
+
+    def store(self, n, data):
+        self.cache[n] = data
+        self.cache.move_to_end(n)
+        while(len(self.cache) > PAGE_CACHE):
+            self.cache.popitem(last=False)
+
+    def page(self, n):
+        if(n not in self.cache):
+            self.prefetch([n])
+        data = self.cache.get(n, b"")
+        self.cache.move_to_end(n)
+        if(n == 1):
+            return BTreePage(data[100:], 1, self.get_offset(1), 100, self.encoding)
+        return BTreePage(data, n, self.get_offset(n), encoding=self.encoding)
+
+    def overview(self):
+        dbsize = self.header.get_db_size()[0]
+        lines = []
+        for n in range(1, len(self) + 1):
+            pageheader = self.get_pageheader(n)
+            if(n > 1 and self.types[n-1] == 0x00):
+                f = FreeTrunkPage(pageheader)
+                line = "Potential free-page, Offset: 0x%08x, Number: %d, Next Trunk: %d, #Leafes:%d" % (
+                    self.get_offset(n), n, f.get_next_trunk_page()[0], f.get_pointer_count()[0])
+            else:
+                line = BTreePage(pageheader, n, self.get_offset(n)).shortinfo()
+            if(self.is_partial(n)):
+                line += colorred + " (Partial page: %d of %d bytes)" % (self.lastlength, self.pagesize) + coloroff
+            if(n > dbsize):
+                line += coloryellow + " (Beyond header DB size)" + coloroff
+            lines.append(line)
+        return "\n".join(lines) + "\n"
+
+
+class ImageScanner:
+    """Class scanning a raw image for embedded SQLite databases and orphaned b tree pages."""
+
+    def __init__(self, image, chunksize=SCAN_CHUNK_SIZE):
+        self.image = image
+        self.chunksize = max(1, chunksize // PAGE_SIZES[-1]) * PAGE_SIZES[-1]
+        self.reader = PageReader(image, PAGE_SIZES[0])
+
+    def close(self):
+        self.reader.close()
+
+    def check_page(self, buf, pos):
+        # Returns the smallest page size for which the bytes at pos look like a b tree page header, 0 if none does.
+        if(pos + 12 > len(buf)):
+            return 0
+        pagetype = buf[pos]
+        headerlength = 12 if(pagetype == 0x02 or pagetype == 0x05) else 8
+        freeblock = int.from_bytes(buf[pos+1:pos+3], "big", signed=False)
+        cellcount = int.from_bytes(buf[pos+3:pos+5], "big", signed=False)
+        datastart = int.from_bytes(buf[pos+5:pos+7], "big", signed=False)
+        if(datastart == 0):
+            datastart = 65536
+        if(cellcount == 0 or buf[pos+7] > 60 or headerlength + cellcount * 2 > datastart):
+            return 0
+        if(freeblock != 0 and freeblock < datastart):
+            return 0
+        if(headerlength == 12 and int.from_bytes(buf[pos+8:pos+12], "big", signed=False) == 0):
+            return 0
+        end = min(pos + headerlength + cellcount * 2, len(buf))
+        end -= (end - pos - headerlength) % 2
+        pointers = struct.unpack(">%dH" % ((end - pos - headerlength) // 2), buf[pos+headerlength:end])
+        if(len(pointers) > 0 and min(pointers) < datastart):
+            return 0
+        highest = max(max(pointers, default=0), freeblock, datastart - 1)
+        for pagesize in PAGE_SIZES:
+            if(highest < pagesize):
+                return pagesize
+        return 0
+
+    def scan(self):
+        # Yields ("database", offset, header) and ("page", offset, pagesize) ordered by offset
+        tail = b""
+        limit = get_file_size(self.image)
+        if(limit is None):
+            limit = 2**63
+        for base, buf in self.reader.iter_chunks(0, limit, self.chunksize):
+            n = len(buf)
+            view = memoryview(buf)
+            hits = []
+            # The magic string can span the border between two chunks
+            pos = (tail + bytes(view[:len(SQLITE_MAGIC)-1])).find(SQLITE_MAGIC)
+            if(pos >= 0):
+                hits.append((base - len(tail) + pos, "database"))
+            pos = buf.find(SQLITE_MAGIC)
+            while(pos >= 0):
+                hits.append((base + pos, "database"))
+                pos = buf.find(SQLITE_MAGIC, pos + 1)
+            # Only the first byte of every 512 byte block is matched in python
+            for m in PAGE_TYPES.finditer(view[::PAGE_SIZES[0]].tobytes()):
+                pos = m.start() * PAGE_SIZES[0]
+                pagesize = self.check_page(view, pos)
+                if(pagesize):
+                    hits.append((base + pos, pagesize))
+            hits.sort(key=lambda h: h[0])
+            for offset, value in hits:
+                if(value == "database"):
+                    yield "database", offset, Header(self.reader.read_range(offset, 100))
+                else:
+                    yield "page", offset, value
+            tail = bytes(view[max(0, n-len(SQLITE_MAGIC)+1):])
+
+    def groups(self, gap=ORPHAN_GAP):
+        # Yields ("database", offset, pagesize, headerpages, foundpages) and ("orphans", pagesize, offsets)
+        # The header DB size of carved databases is often wrong, so a database also
+        # covers the following page hits aligned to its page size and at most gap pages apart
+        database = None
+        dbend = 0
+        orphans = []
+        orphansize = 0
+        for kind, offset, value in self.scan():
+            if(database is not None and (kind == "database" or offset >= max(database[3], database[4]) + gap * database[1])):
+                yield "database", database[0], database[1], database[2], (database[4] - database[0]) // database[1]
+                database = None
+            if(kind == "database"):
+                if(len(orphans) > 0):
+                    yield "orphans", orphansize, orphans
+                    orphans = []
+                pagesize = value.get_page_size()[0]
+                pages = value.get_db_size()[0]
+                if(pagesize >= PAGE_SIZES[0]):
+                    # offset, page size, header pages, end of the header extent, end of the last page found
+                    database = [offset, pagesize, pages, offset + pagesize * pages, offset + pagesize]
+                    dbend = max(dbend, database[3], database[4])
+                else:
+                    yield "database", offset, pagesize, pages, 0
+            elif(database is not None and value <= database[1] and (offset - database[0]) % database[1] == 0):
+                database[4] = max(database[4], offset + database[1])
+                dbend = max(dbend, database[4])
+            elif(offset >= dbend):
+                if(len(orphans) > 0 and (offset - orphans[-1] > gap * orphansize or len(orphans) >= ORPHAN_MAX
+                                         or value > orphansize or (offset - orphans[0]) % orphansize != 0)):
+                    yield "orphans", orphansize, orphans
+                    orphans = []
+                if(len(orphans) == 0):
+                    orphansize = value
+                orphans.append(offset)
+        if(database is not None):
+            yield "database", database[0], database[1], database[2], (database[4] - database[0]) // database[1]
+        if(len(orphans) > 0):
+            yield "orphans", orphansize, orphans
+
+    def load_pages(self, pagesize, offsets):
+        blocks = self.reader.read_blocks(offsets, pagesize)
+        pages = []
+        for offset in offsets:
+            if(offset in blocks):
+                pages.append(BTreePage(blocks[offset], offset // pagesize + 1, offset))
+        return pages
+
+
 def analyzePage(header, page, pagenr, negoffset=0, proof=False):
     print("\n")
     print(page.info())
@@ -593,6 +946,7 @@ def showBTree(header, pages, start, name, g):
         '{BTree Root:%s | <f%d> %d}' % (name, start, start)))
     if(len(childs) > 0):
         print(childs)
+        pages.prefetch([c for c in childs if(pages.is_interior(c))])
         if not(len(pages[childs[0]-1].get_tree_childs()) > 0):
             childstring = "{<f%d> Leaves: | %d" % (childs[0], childs[0])
             for i, c in enumerate(childs[1:]):
@@ -616,6 +970,7 @@ def showBTreeSubNodes(header, pages, start, g):
     g.node('node%d' % start, nohtml('<f%d> %d' % (start, start)))
     if(len(childs) > 0):
         print(childs)
+        pages.prefetch([c for c in childs if(pages.is_interior(c))])
         if not(len(pages[childs[0]-1].get_tree_childs()) > 0):
             childstring = "{<f%d> Leaves: | %d" % (childs[0], childs[0])
             for i, c in enumerate(childs[1:]):
@@ -634,7 +989,131 @@ def showBTreeSubNodes(header, pages, start, g):
     return g
 
 
-def interactive(header, pages, overview, proof=False):
+def get_freelist_pages(header, pages):
+    # 1 marks freelist leaf pages, 2 freelist trunk pages
+    flags = bytearray(len(pages) + 1)
+    trunk = header.get_first_free_page()[0]
+    while(0 < trunk <= len(pages) and not flags[trunk]):
+        flags[trunk] = 2
+        f = FreeTrunkPage(pages[trunk-1].pagebytes)
+        count = min(f.get_pointer_count()[0], (len(f.pagebytes) - 8) // 4)
+        for leaf in struct.unpack_from(">%dI" % count, f.pagebytes, 8):
+            if(0 < leaf <= len(pages) and not flags[leaf]):
+                flags[leaf] = 1
+        trunk = f.get_next_trunk_page()[0]
+    return flags
+
+
+def measureSlack(header, pages):
+    freelist = get_freelist_pages(header, pages)
+    freebytes = array.array("I")
+    fragments = array.array("B")
+    gaps = array.array("I")
+    gapdata = array.array("I")
+    length = (len(pages) - 1) * pages.pagesize + pages.lastlength
+    for n, offset, p in iter_pages(pages.reader.db, header, base=pages.base, length=length):
+        if(n > len(pages)):
+            break
+        free = 0
+        fragment = 0
+        gap = 0
+        data = 0
+        pagetype = pages.types[n-1]
+        if(freelist[n]):
+            start = 0
+            if(freelist[n] == 2):
+                f = FreeTrunkPage(p)
+                start = min(8 + 4 * f.get_pointer_count()[0], len(p))
+            gap = len(p) - start
+            data = gap - p.count(0, start)
+        elif(pagetype == 0x02 or pagetype == 0x05 or pagetype == 0x0a or pagetype == 0x0d):
+            fragment = pages.fragments[n-1]
+            start = (100 if(n == 1) else 0) + (12 if(pagetype < 0x0a) else 8) + pages.cellcounts[n-1] * 2
+            end = min(pages.datastarts[n-1] or 65536, len(p))
+            if(end > start):
+                gap = end - start
+                data = gap - p.count(0, start, end)
+            # Freeblocks are sorted by offset, anything else is a broken chain
+            freeblock = pages.freeblocks[n-1]
+            while(freeblock != 0 and freeblock + 4 <= len(p)):
+                free += int.from_bytes(p[freeblock+2:freeblock+4], "big", signed=False)
+                nextblock = int.from_bytes(p[freeblock:freeblock+2], "big", signed=False)
+                if(nextblock <= freeblock):
+                    break
+                freeblock = nextblock
+        freebytes.append(free)
+        fragments.append(fragment)
+        gaps.append(gap)
+        gapdata.append(data)
+    return freebytes, fragments, gaps, gapdata, freelist
+
+
+def get_heat_level(score, maxscore):
+    # Logarithmic scale, the page with the highest score gets the last character
+    if(score == 0):
+        return 0
+    if(maxscore <= 1):
+        return len(HEAT_CHARS) - 1
+    return min(1 + int((len(HEAT_CHARS) - 2) * math.log(score) / math.log(maxscore)), len(HEAT_CHARS) - 1)
+
+
+def slackReport(header, pages, top=20, htmlfile="slack.html"):
+    freebytes, fragments, gaps, gapdata, freelist = measureSlack(header, pages)
+    scores = [freebytes[i] + fragments[i] + gapdata[i] for i in range(len(freebytes))]
+    maxscore = max(scores, default=0)
+    s = colorblue + "Pages with the most slack space:\n" + coloroff
+    s += "\t%8s %12s %10s %10s %10s %10s %s\n" % (
+        "Page", "Offset", "Score", "Freeblocks", "Fragments", "Gap", "Gap data")
+    for i in heapq.nlargest(top, range(len(scores)), key=scores.__getitem__):
+        if(scores[i] == 0):
+            break
+        s += "\t%8d %12s %10d %10d %10d %10d %d%s\n" % (
+            i + 1, "0x%08x" % pages.get_offset(i + 1), scores[i], freebytes[i], fragments[i],
+            gaps[i], gapdata[i], " (freelist)" if(freelist[i+1]) else "")
+    s += colorblue + "\nHeatmap (%d pages per line, '%s' from no to most slack, freelist pages with red background):\n" % (
+        HEAT_WIDTH, HEAT_CHARS) + coloroff
+    html = ""
+    for row in range(0, len(scores), HEAT_WIDTH):
+        s += "%8d " % (row + 1)
+        html += "%8d " % (row + 1)
+        run = ""
+        runstyle = None
+        for i in range(row, min(row + HEAT_WIDTH, len(scores)) + 1):
+            if(i < min(row + HEAT_WIDTH, len(scores))):
+                level = get_heat_level(scores[i], maxscore)
+                style = (HEAT_COLORS[level], freelist[i+1])
+            else:
+                style = None
+            if(style != runstyle and len(run) > 0):
+                if(runstyle[1]):
+                    s += colorredbg + run + coloroff
+                    html += '<span style="color:%s; background-color:#5f0000;">%s</span>' % (runstyle[0], run)
+                else:
+                    s += run
+                    html += '<span style="color:%s;">%s</span>' % (runstyle[0], run)
+                run = ""
+            if(style is not None):
+                runstyle = style
+                run += HEAT_CHARS[level]
+        s += "\n"
+        html += "\n"
+    if(htmlfile is not None):
+        with open(htmlfile, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+            f.write('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n')
+            f.write('<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n')
+            f.write('<meta http-equiv="Content-Type" content="application/xml+xhtml; charset=UTF-8"/>\n')
+            f.write('<title>Slack space heatmap</title>\n</head>\n')
+            f.write('<body style="color:white; background-color:black">\n<pre>\n')
+            f.write("Slack space heatmap, %d pages per line, '%s' from no to most slack, freelist pages with red background\n\n" % (
+                HEAT_WIDTH, HEAT_CHARS))
+            f.write(html)
+            f.write("</pre>\n</body>\n</html>\n")
+        s += "\nHeatmap written to %s\n" % htmlfile
+    return s
+
+
+def interactive(header, pages, proof=False):
     exit = False
     global Digraph, nohtml
     while not exit:
@@ -652,7 +1131,7 @@ def interactive(header, pages, overview, proof=False):
         if(cmdline[0] == "o"):
             try:
                 pydoc.pipepager(
-                    colorblue+"Showing overview of pages:\n"+coloroff+overview, cmd='less -R')
+                    colorblue+"Showing overview of pages:\n"+coloroff+pages.overview(), cmd='less -R')
             except Exception as e:
                 print(e)
                 print("Error with the overview")
@@ -664,6 +1143,7 @@ def interactive(header, pages, overview, proof=False):
                 if(len(cmdline) == 1):
                     tablenames, tablepagenrs = pages[0].read_data_master()
                     print(tablepagenrs)
+                    pages.prefetch(tablepagenrs)
                     for i in range(0, len(tablenames)):
                         print("i:%d pagenr:%d name:%s" %
                               (i, tablepagenrs[i], tablenames[i]))
@@ -723,6 +1203,16 @@ def interactive(header, pages, overview, proof=False):
             except Exception as e:
                 print("Error with this page")
                 print(e)
+        if(cmdline[0] == "sr"):
+            try:
+                data = slackReport(header, pages, 20 if(len(cmdline) == 1) else int(cmdline[1]))
+                if(len(data.split("\n")) <= 1000):
+                    print(data)
+                else:
+                    pydoc.pipepager(data, cmd='less -R')
+            except Exception as e:
+                print("Error with the slack report")
+                print(e)
         if(cmdline[0] == "fl"):
             try:
                 from graphviz import Digraph, nohtml
@@ -744,35 +1234,94 @@ def interactive(header, pages, overview, proof=False):
             print("f <n>\t\tanalyze page <n> (As a freelist trunk page)")
             print("fcl <n>\t\tCheck if freelist-leaf page <n> is empty")
             print("fl\t\tShow freelist graph")
+            print("sr <n>\t\tRank the n pages with the most slack space and show a heatmap (Default n=20)")
             print("exit|q\t\texit")
 
 
-def analyze(db, proof=False):
+def scanImage(image):
+    scanner = ImageScanner(image)
+    databases = 0
+    orphans = 0
+    for group in scanner.groups():
+        if(group[0] == "database"):
+            databases += 1
+            print(colorgreen + "Database at offset 0x%010x, Page size: %d, DB Size(Pages): %d" % group[1:4] + coloroff)
+            if(group[3] == 0 or group[3] < group[4]):
+                print(colorred + "\tHeader declares %d pages, but pages were found up to page %d!" % group[3:5] + coloroff)
+            elif(group[3] > group[4]):
+                print(coloryellow + "\tHeader declares %d pages, but b tree pages were only found up to page %d. The database might be truncated." % group[3:5] + coloroff)
+            print("\tUse --offset 0x%x --length 0x%x to analyze it." % (group[1], group[2] * max(group[3], group[4], 1)))
+        else:
+            orphans += len(group[2])
+            print(coloryellow + "%d orphaned pages, Page size: %d, Offset: 0x%010x - 0x%010x" % (
+                len(group[2]), group[1], group[2][0], group[2][-1]) + coloroff)
+            for page in scanner.load_pages(group[1], group[2]):
+                print("\t" + page.shortinfo())
+    scanner.close()
+    print("Found %d databases and %d orphaned pages." % (databases, orphans))
+
+
+def get_file_size(db):
+    try:
+        size = os.fstat(db.fileno()).st_size
+        if(size == 0):
+            # Block devices report a size of 0
+            pos = db.tell()
+            size = db.seek(0, os.SEEK_END)
+            db.seek(pos)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def iter_pages(db, header, chunksize=CHUNK_SIZE, base=0, length=None):
+    # Yields (number, offset, pagebytes) up to the end of the file or base + length, the last page may be short
+    pagesize = header.get_page_size()[0]
+    filesize = get_file_size(db)
+    if(length is not None):
+        limit = base + length
+    elif(filesize is None):
+        limit = base + header.get_db_size()[0] * pagesize
+    else:
+        limit = filesize
+    readsize = max(1, chunksize // pagesize) * pagesize
+    number = 1
+    reader = PageReader(db, pagesize, base)
+    try:
+        for offset, chunk in reader.iter_chunks(base, limit, readsize):
+            for i in range(0, len(chunk), pagesize):
+                yield number, offset + i, chunk[i:i+pagesize]
+                number += 1
+    finally:
+        reader.close()
+
+
+def analyze(db, proof=False, base=0, length=None):
+    db.seek(base)
     headerbytes = db.read(100)
-    offset = 100
     header = Header(headerbytes)
     print(header.info(proof))
-    p = db.read(header.get_page_size()[0] - 100)
-    b = BTreePage(p, 1, 100, offset)
-    offset = header.get_page_size()[0]
-    pages = [b]
-    overview = b.shortinfo() + "\n"
-    for i in range(2, header.get_db_size()[0]+1):
-        p = db.read(header.get_page_size()[0])
-        b = BTreePage(p, i, offset)
-        if(b.get_pagetype()[1] == 0x00):
-            f = FreeTrunkPage(b.pagebytes)
-            overview += "Potential free-page, Offset: 0x%08x, Number: %d, Next Trunk: %d, #Leafes:%d\n" % (
-                offset, i, f.get_next_trunk_page()[0], f.get_pointer_count()[0])
+    pagesize = header.get_page_size()[0]
+    if(pagesize <= 100):
+        print(colorred+"Page size %d can not be used to read pages." % pagesize+coloroff)
+        return
+    dbsize = header.get_db_size()[0]
+    pages = PageTable(db, header, base)
+    try:
+        for i, offset, p in iter_pages(db, header, base=base, length=length):
+            pages.add(p)
+        if(len(pages) != dbsize):
+            print(colorred + "Header declares %d pages, but the file contains %d pages!" % (
+                dbsize, len(pages)) + coloroff)
+        if(len(pages) > 0 and pages.is_partial(len(pages))):
+            print(colorred + "The last page is truncated, the file is not a multiple of the page size!" + coloroff)
+        if(len(pages) > 30):
+            pydoc.pipepager(colorblue+"Showing overview of pages:\n"+coloroff+pages.overview(), cmd='less -R')
         else:
-            overview += b.shortinfo() + "\n"
-        offset += header.get_page_size()[0]
-        pages.append(b)
-    if(header.get_db_size()[0] > 30):
-        pydoc.pipepager(colorblue+"Showing overview of pages:\n"+coloroff+overview, cmd='less -R')
-    else:
-        print(overview)
-    interactive(header, pages, overview)
+            print(pages.overview())
+        interactive(header, pages)
+    finally:
+        pages.close()
 
 
 def main():
@@ -781,14 +1330,23 @@ def main():
     parser.add_argument("database", help="SQLite database file to be examined")
     parser.add_argument('--proof', action='store_true',
                         help="show proofs when possible (not yet implemented)")
+    parser.add_argument('--scan', action='store_true',
+                        help="scan a raw image for embedded databases and orphaned pages")
+    parser.add_argument('--offset', type=lambda x: int(x, 0), default=0,
+                        help="offset of the database inside the file (e.g. found with --scan)")
+    parser.add_argument('--length', type=lambda x: int(x, 0), default=None,
+                        help="length of the database inside the file in bytes (Default: up to the end of the file)")
     args = parser.parse_args()
     try:
         db = open(args.database, "rb")
     except OSError:
         print("Try using a database that actually exists.")
     else:
-        print("Real file size: %d\n\n" % os.stat(args.database).st_size)
-        analyze(db, args.proof)
+        print("Real file size: %d\n\n" % get_file_size(db))
+        if(args.scan):
+            scanImage(db)
+        else:
+            analyze(db, args.proof, args.offset, args.length)
 
 
 if __name__ == "__main__":